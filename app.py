@@ -7,19 +7,31 @@ import datetime
 from dateutil.relativedelta import relativedelta
 from fpdf import FPDF
 import os
-import json
 from io import BytesIO
 import uuid # Necessário para criar IDs únicos
+import threading # Listener do Firestore roda em thread própria
+import time
+import logging
+import types
+import hashlib
+import collections
 import firebase_admin
 from firebase_admin import credentials, firestore
 from google.oauth2 import service_account
 import plotly.express as px # Para o gráfico de linha
 
+logger = logging.getLogger(__name__)
+
 # ==============================================================================
 # CONFIGURAÇÃO DO BANCO DE DADOS (FIRESTORE)
 # ==============================================================================
 # Define o nome da coleção no Firestore
 DB_COLLECTION = "cci_operacoes"
+# Subcoleção com o histórico de análises de cada operação: cci_operacoes/{op_id}/historico/{analise_ref}
+DB_SUBCOLLECTION_HISTORICO = "historico"
+
+# Campos necessários para o painel (projeção da query; o documento completo é lido sob demanda)
+CAMPOS_PAINEL = ['op_nome', 'op_codigo', 'op_tipo', 'op_volume', 'rating_final_operacao']
 
 # --- DEFINIÇÃO DOS VALORES PADRÃO ---
 default_emissao = datetime.date(2024, 5, 1)
@@ -51,6 +63,58 @@ DEFAULTS_ANALISE = {
 # Combinação para inicialização e para coletar dados da sessão
 DEFAULTS = {**DEFAULTS_CADASTRO, **DEFAULTS_ANALISE, 'historico_analises': {}}
 
+# Nomes dos atributos do scorecard (tela e PDF)
+NOMES_INPUTS = {
+    'ltv': '1. LTV',
+    'demanda': '2. Demanda',
+    'behavior': '3. Behavior',
+    'comprometimento': '4. Comprometimento de Renda',
+    'inadimplencia': '5. Inadimplência'
+}
+
+# Campos de data do cadastro: datetime.date no session_state (tipo exigido pelo st.date_input),
+# datetime.datetime no Firestore (que não aceita datetime.date)
+CAMPOS_DATA = frozenset({'op_data_emissao', 'op_data_vencimento'})
+
+# Faixas de atraso das penalizações (Behavior e Inadimplência): (sufixo da chave, rótulo)
+FAIXAS_ATRASO = (('30_60', '30-60 dias'), ('60_90', '60-90 dias'), ('90_mais', '>90 dias'))
+
+def campos_penalizacao(prefixo, rotulo):
+    """Campos (chave, rótulo, opções) das três faixas de atraso de uma penalização."""
+    return [(f'{prefixo}_{sufixo}', f'{rotulo} {faixa}', dict(min_value=0, step=1)) for sufixo, faixa in FAIXAS_ATRASO]
+
+# Widgets da aba de Inputs: por coluna, seções (título, [(chave, rótulo, opções do st.number_input)])
+ESQUEMA_INPUTS = (
+    (
+        ("1. LTV (Loan-to-Value)", [
+            ('input_ltv', "LTV da operação (%)", dict(min_value=0.0, max_value=200.0, step=1.0, format="%.2f")),
+        ]),
+        ("2. Demanda", [
+            ('input_demanda', "Valor da Demanda (Ex: R$)", dict(min_value=0, step=1000)),
+        ]),
+        ("3. Behavior (Penalização)", campos_penalizacao('input_behavior', "Qtd. Atrasos")),
+    ),
+    (
+        ("4. Comprometimento de Renda", [
+            ('input_comprometimento', "Comprometimento de Renda (%)", dict(min_value=0.0, max_value=100.0, step=0.5, format="%.2f")),
+        ]),
+        ("5. Inadimplência (Penalização)", campos_penalizacao('input_inad', "Qtd. Inad.")),
+    ),
+)
+
+# Peso de cada atributo no scorecard (todos iguais) e sua forma já formatada para tabelas
+PESO_ATRIBUTO = 0.20
+PESO_ATRIBUTO_TEXTO = f"{PESO_ATRIBUTO * 100:.0f}%"
+
+# Horário usado para converter datetime.date em datetime.datetime ao salvar
+MEIA_NOITE = datetime.datetime.min.time()
+
+# Chaves do session_state usadas no relatório PDF
+CHAVES_RELATORIO = [*DEFAULTS_CADASTRO, 'analise_ref_atual', 'justificativa_final', 'scores_operacao', 'rating_final_operacao']
+
+# Chaves dos inputs da análise ('input_*'), na ordem de DEFAULTS_ANALISE
+CHAVES_INPUT = tuple(key for key in DEFAULTS_ANALISE if key.startswith('input_'))
+
 # ==============================================================================
 # CONEXÃO COM O FIREBASE
 # ==============================================================================
@@ -62,9 +126,9 @@ def get_firestore_client():
     Usa st.cache_resource para garantir que isso seja executado apenas uma vez.
     """
     try:
-        creds_json = dict(st.secrets["firebase_service_account"])
-        
         if not firebase_admin._apps:
+            # As credenciais só são lidas dos Secrets quando o app ainda não foi inicializado
+            creds_json = dict(st.secrets["firebase_service_account"])
             cred_obj = credentials.Certificate(creds_json)
             firebase_admin.initialize_app(cred_obj)
             
@@ -75,22 +139,251 @@ def get_firestore_client():
         st.error(e)
         return None
 
-@st.cache_data(ttl=300) # Cache de 5 minutos
-def carregar_db():
-    """Carrega todos os dados do Firestore."""
+# Tamanho da página nas leituras da coleção
+TAMANHO_PAGINA = 500
+
+# O que o painel exibe, montado uma vez sempre que os dados mudam (e não a cada rerun):
+# `operacoes` é a visão somente leitura {op_id: campos}; `internas`/`externas`, a partição por tipo;
+# `volume` e `ratings` (Counter rating -> nº de operações, None = sem rating) alimentam o resumo
+DadosPainel = collections.namedtuple('DadosPainel', ['operacoes', 'internas', 'externas', 'volume', 'ratings'])
+
+def montar_dados_painel(operacoes):
+    """Separa as operações em internas e externas e soma os totais do resumo numa só passada."""
+    internas, externas = [], []
+    volume, ratings = 0.0, collections.Counter()
+    for item in operacoes.items():
+        op_data = item[1]
+        (internas if op_data.get('op_tipo', 'Interna') == 'Interna' else externas).append(item)
+        op_volume = op_data.get('op_volume')
+        if isinstance(op_volume, (int, float)) and not isinstance(op_volume, bool):
+            volume += op_volume
+        ratings[(op_data.get('rating_final_operacao') or {}).get('rating_final')] += 1
+    return DadosPainel(operacoes, tuple(internas), tuple(externas), volume, ratings)
+
+PAINEL_VAZIO = montar_dados_painel(types.MappingProxyType({}))
+
+def _carregar_pagina(db, cursor=None, tamanho=TAMANHO_PAGINA, campos=CAMPOS_PAINEL):
+    """Lê uma página de operações (só `campos`), começando após o documento `cursor`."""
+    query = db.collection(DB_COLLECTION).select(campos).limit(tamanho)
+    if cursor is not None:
+        query = query.start_after(cursor)
+    return list(query.stream())
+
+def _carregar_operacoes(db):
+    """Lê os campos do painel de todas as operações em páginas com cursor (visão somente leitura)."""
+    db_data = {}
+    pagina = _carregar_pagina(db)
+    while pagina:
+        for op in pagina:
+            db_data[op.id] = op.to_dict()
+        if len(pagina) < TAMANHO_PAGINA:
+            break
+        pagina = _carregar_pagina(db, cursor=pagina[-1])
+    return types.MappingProxyType(db_data)
+
+# Idade (em segundos) a partir da qual o cache das operações é recarregado em segundo plano
+TTL_CACHE_DB = 300
+
+class CacheOperacoes:
+    """
+    Cache das operações compartilhado pelo processo, no esquema "stale-while-revalidate":
+    depois de expirado, os dados antigos continuam sendo servidos enquanto uma thread recarrega.
+    Só a primeira leitura e a leitura após uma gravação (invalidar) esperam o Firestore.
+    Cada invalidar() inicia uma nova geração: leituras iniciadas antes dela são descartadas.
+    """
+    def __init__(self):
+        self.dados = None
+        self.carregado_em = 0.0
+        self._lock = threading.Lock()
+        self._atualizando = False
+        self._geracao = 0
+
+    def obter(self, db):
+        # Lê o atributo uma vez só: um invalidar() de outra sessão pode zerá-lo a qualquer momento
+        dados = self.dados
+        if dados is None:
+            with self._lock: # Evita várias sessões lendo a coleção ao mesmo tempo
+                dados = self.dados
+                if dados is None:
+                    dados = self._guardar(_carregar_operacoes(db))
+        elif time.monotonic() - self.carregado_em > TTL_CACHE_DB:
+            with self._lock:
+                iniciar = not self._atualizando
+                self._atualizando = True
+                geracao = self._geracao
+            if iniciar:
+                threading.Thread(target=self._atualizar, args=(db, geracao), daemon=True).start()
+        return dados
+
+    def _guardar(self, dados):
+        self.dados = montar_dados_painel(dados)
+        self.carregado_em = time.monotonic()
+        return self.dados
+
+    def _atualizar(self, db, geracao):
+        try:
+            dados = _carregar_operacoes(db)
+            with self._lock:
+                # Uma gravação (invalidar) no meio da leitura torna estes dados anteriores a ela
+                if geracao == self._geracao:
+                    self._guardar(dados)
+        except Exception:
+            # Sem contexto do Streamlit nesta thread: mantém os dados antigos e tenta de novo no próximo acesso
+            logger.exception("Erro ao atualizar o cache do Firestore")
+        finally:
+            self._atualizando = False
+
+    def invalidar(self):
+        with self._lock:
+            self.dados = None
+            self._geracao += 1
+
+@st.cache_resource(show_spinner=False)
+def obter_cache_operacoes():
+    """Instância única (por processo) do cache de operações usado quando não há listener."""
+    return CacheOperacoes()
+
+def carregar_db_cached():
+    """Carrega os dados do painel (DadosPainel) pelo cache compartilhado."""
     db = get_firestore_client()
     if db is None:
-        return {}
+        return PAINEL_VAZIO
         
     try:
-        operacoes_ref = db.collection(DB_COLLECTION).stream()
-        db_data = {}
-        for op in operacoes_ref:
-            db_data[op.id] = op.to_dict()
-        return db_data
+        return obter_cache_operacoes().obter(db)
     except Exception as e:
         st.error(f"Erro ao carregar dados do Firestore: {e}")
-        return {}
+        return PAINEL_VAZIO
+
+# Espera máxima pelo primeiro snapshot do listener (feita uma única vez por listener)
+ESPERA_PRIMEIRO_SNAPSHOT = 10
+# Intervalo mínimo (em segundos) entre tentativas de recriar um listener que parou
+INTERVALO_RECRIAR_OUVINTE = 60
+
+class OuvinteOperacoes:
+    """
+    Mantém em memória os campos do painel de todas as operações, atualizados por um
+    listener (on_snapshot) do Firestore: a coleção é lida uma vez e depois só as mudanças chegam.
+    """
+    def __init__(self, db):
+        self.criado_em = time.monotonic()
+        self._esperou = False
+        self.dados = types.MappingProxyType({}) # Substituído (nunca alterado) a cada snapshot: leitores não precisam de lock
+        self.painel = PAINEL_VAZIO # Idem, montado a partir de `dados` no mesmo snapshot
+        self.versao = 0
+        self.pronto = threading.Event()
+        self._cond = threading.Condition()
+        # Listeners não aceitam projeção (select), então os campos do painel são filtrados aqui
+        self._watch = db.collection(DB_COLLECTION).on_snapshot(self._on_snapshot)
+
+    def _on_snapshot(self, docs, changes, read_time):
+        with self._cond:
+            dados = dict(self.dados)
+            for change in changes:
+                doc = change.document
+                if change.type.name == 'REMOVED':
+                    dados.pop(doc.id, None)
+                else:
+                    dados[doc.id] = {k: v for k, v in (doc.to_dict() or {}).items() if k in CAMPOS_PAINEL}
+            self.dados = types.MappingProxyType(dados)
+            self.painel = montar_dados_painel(self.dados)
+            self.versao += 1
+            self._cond.notify_all()
+        self.pronto.set()
+
+    def ativo(self):
+        """True se já recebeu o primeiro snapshot e o stream do listener continua aberto."""
+        return self.pronto.is_set() and self._watch.is_active
+
+    def disponivel(self, esperar=True):
+        """Como ativo(), mas na primeira chamada pode esperar o primeiro snapshot (uma única vez)."""
+        if esperar and not self._esperou:
+            self._esperou = True
+            self.pronto.wait(timeout=ESPERA_PRIMEIRO_SNAPSHOT)
+        return self.ativo()
+
+    def encerrar(self):
+        try:
+            self._watch.unsubscribe()
+        except Exception:
+            logger.exception("Erro ao encerrar o listener do Firestore")
+
+    def aguardar_atualizacao(self, versao, timeout=2.0):
+        """Bloqueia até chegar um snapshot mais novo que `versao` (ex: após uma gravação)."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.versao > versao, timeout)
+
+@st.cache_resource(show_spinner=False)
+def _registrar_ouvinte(_db):
+    """Registra o listener da coleção uma única vez por processo (uma falha levanta e não fica no cache)."""
+    return OuvinteOperacoes(_db)
+
+@st.cache_resource(show_spinner=False)
+def _falha_ouvinte():
+    """Momento (time.monotonic) da última falha ao registrar o listener, compartilhado pelo processo."""
+    return {'em': None}
+
+def obter_ouvinte_operacoes():
+    """
+    Listener da coleção, ou None se não houver db ou o registro falhar. Após uma falha o
+    painel usa o cache e uma nova tentativa só é feita depois de INTERVALO_RECRIAR_OUVINTE.
+    """
+    db = get_firestore_client()
+    if db is None:
+        return None
+
+    falha = _falha_ouvinte()
+    if falha['em'] is not None and time.monotonic() - falha['em'] < INTERVALO_RECRIAR_OUVINTE:
+        return None
+    try:
+        return _registrar_ouvinte(db)
+    except Exception:
+        # Só registra no log: o painel segue normalmente pelo cache
+        logger.exception("Erro ao registrar o listener do Firestore")
+        falha['em'] = time.monotonic()
+        return None
+
+def carregar_db():
+    """Retorna os DadosPainel do listener; sem ele, usa o cache compartilhado (recarregado em segundo plano)."""
+    ouvinte = obter_ouvinte_operacoes()
+    if ouvinte is not None:
+        # Só vale esperar o primeiro snapshot se o cache ainda não tem dados para mostrar
+        if ouvinte.disponivel(esperar=obter_cache_operacoes().dados is None):
+            return ouvinte.painel
+        # Listener parado (stream fechado ou sem primeiro snapshot): os dados dele ficariam
+        # congelados. Usa o cache e, de tempos em tempos, descarta-o para ser recriado no próximo acesso
+        if time.monotonic() - ouvinte.criado_em > INTERVALO_RECRIAR_OUVINTE:
+            logger.warning("Listener do Firestore inativo; recriando")
+            ouvinte.encerrar()
+            _registrar_ouvinte.clear()
+    return carregar_db_cached()
+
+def versao_ouvinte():
+    """Versão atual do listener (None se não houver ou estiver inativo), para aguardar o eco de uma gravação."""
+    ouvinte = obter_ouvinte_operacoes()
+    return ouvinte.versao if ouvinte is not None and ouvinte.ativo() else None
+
+def invalidar_cache_db(versao_anterior=None):
+    """
+    Invalida o cache do DB após uma gravação/deleção, forçando recarregar no próximo acesso.
+    Se `versao_anterior` for informada, espera o listener refletir a gravação.
+    """
+    obter_cache_operacoes().invalidar()
+    st.session_state.db_versao = st.session_state.get('db_versao', 0) + 1
+
+    ouvinte = obter_ouvinte_operacoes()
+    if ouvinte is not None and versao_anterior is not None:
+        ouvinte.aguardar_atualizacao(versao_anterior)
+
+def resumo_painel(painel):
+    """
+    Totais do painel (nº de operações, volume e nº por rating) a partir dos DadosPainel já em
+    memória: sem leituras extras e sempre coerentes com as tabelas exibidas.
+    """
+    por_rating = {rating: painel.ratings[rating] for rating in RATING_POR_NOTA.values()}
+    total = len(painel.operacoes)
+    return {'total': total, 'volume': painel.volume, 'por_rating': por_rating,
+            'sem_rating': total - sum(por_rating.values())}
 
 # ==============================================================================
 # INICIALIZAÇÃO E GESTÃO DE ESTADO (SESSION_STATE)
@@ -104,47 +397,54 @@ def inicializar_session_state():
         # Controle de página
         st.session_state.pagina_atual = "painel" # 'painel', 'detalhe' ou 'analise'
         st.session_state.operacao_selecionada_id = None
+        st.session_state.db_versao = 0 # Incrementada a cada gravação no Firestore
         
         # Inicializa os campos do formulário com os padrões
-        limpar_formulario_cadastro()
-        limpar_formulario_analise()
-        st.session_state.historico_analises = {}
+        semear_valores_padrao()
+
+def copiar_padroes(defaults):
+    """Cópia dos padrões com dicts novos, para não compartilhar o padrão mutável entre sessões."""
+    return {key: dict(value) if isinstance(value, dict) else value for key, value in defaults.items()}
+
+def semear_valores_padrao():
+    """Preenche com os padrões apenas as chaves que ainda não existem no st.session_state."""
+    ss = st.session_state
+    ss.update(copiar_padroes({key: value for key, value in DEFAULTS.items() if key not in ss}))
 
 def limpar_formulario_cadastro():
     """Reseta o session_state para os valores padrão de CADASTRO."""
-    for key, value in DEFAULTS_CADASTRO.items():
-        st.session_state[key] = value
+    st.session_state.update(copiar_padroes(DEFAULTS_CADASTRO))
 
 def limpar_formulario_analise():
     """Reseta o session_state para os valores padrão de ANÁLISE."""
-    for key, value in DEFAULTS_ANALISE.items():
-        st.session_state[key] = value
+    st.session_state.update(copiar_padroes(DEFAULTS_ANALISE))
 
 def coletar_dados_estaticos_da_sessao():
     """Coleta apenas os dados de CADASTRO (estáticos) do st.session_state para salvar."""
-    dados = {}
-    for key in DEFAULTS_CADASTRO.keys():
-        if key in st.session_state:
-            value = st.session_state[key]
-            if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
-                dados[key] = datetime.datetime.combine(value, datetime.datetime.min.time())
-            else:
-                dados[key] = value
+    ss = st.session_state
+    dados = {key: ss[key] for key in DEFAULTS_CADASTRO if key in ss}
+    # Só os campos de data precisam de conversão (date -> datetime para o Firestore)
+    for key in CAMPOS_DATA & dados.keys():
+        dados[key] = datetime.datetime.combine(dados[key], MEIA_NOITE)
     return dados
 
+def coletar_inputs_da_sessao():
+    """Coleta os inputs da análise (chaves 'input_*') do st.session_state."""
+    ss = st.session_state # Acessa o proxy do session_state uma única vez
+    return {key: ss[key] for key in CHAVES_INPUT}
+
 def coletar_dados_analise_da_sessao():
     """Coleta apenas os dados da ANÁLISE ATIVA do st.session_state para salvar no histórico."""
     
+    ss = st.session_state
+    
     # 1. Coleta os inputs
-    inputs = {}
-    for key in DEFAULTS_ANALISE.keys():
-        if key.startswith('input_'):
-            inputs[key] = st.session_state[key]
+    inputs = coletar_inputs_da_sessao()
             
     # 2. Coleta os resultados
-    scores = st.session_state.scores_operacao
-    resultados = st.session_state.rating_final_operacao
-    justificativa = st.session_state.justificativa_final
+    scores = ss.scores_operacao
+    resultados = ss.rating_final_operacao
+    justificativa = ss.justificativa_final
     
     # 3. Monta o pacote da análise
     pacote_analise = {
@@ -156,12 +456,57 @@ def coletar_dados_analise_da_sessao():
     }
     return pacote_analise
 
+def coletar_dados_relatorio():
+    """Coleta do st.session_state os dados usados no relatório PDF."""
+    return {key: st.session_state[key] for key in CHAVES_RELATORIO}
+
 # ==============================================================================
 # FUNÇÕES AUXILIARES (Gráficos, PDF, etc.)
 # ==============================================================================
 
+LOGO_PATH = "assets/seu_logo.png"
+
+@st.cache_resource
+def carregar_logo():
+    """Lê o logo uma única vez por processo. Retorna os bytes ou None se não existir."""
+    if not os.path.exists(LOGO_PATH):
+        return None
+    with open(LOGO_PATH, "rb") as f:
+        return f.read()
+
+# Acima deste número de pontos, o gráfico de evolução é reduzido por LTTB antes de ir ao navegador
+LIMITE_PONTOS_GRAFICO = 300
+
+def indices_lttb(y, n_saida):
+    """
+    Índices dos pontos mantidos pelo Largest-Triangle-Three-Buckets (x = posição na série).
+    Preserva o primeiro e o último ponto e, em cada balde, o que forma o maior triângulo
+    com o ponto escolhido antes e a média do balde seguinte.
+    """
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if n_saida >= n or n_saida < 3:
+        return np.arange(n)
+
+    limites = np.linspace(1, n - 1, n_saida - 1).astype(int) # Baldes internos (sem o 1º e o último ponto)
+    indices = [0]
+    for i in range(n_saida - 2):
+        inicio, fim = limites[i], limites[i + 1]
+        prox_inicio, prox_fim = fim, (limites[i + 2] if i + 2 < len(limites) else n)
+        x_medio, y_medio = (prox_inicio + prox_fim - 1) / 2, y[prox_inicio:prox_fim].mean()
+        a = indices[-1]
+        xs = np.arange(inicio, fim)
+        areas = np.abs((a - x_medio) * (y[inicio:fim] - y[a]) - (a - xs) * (y_medio - y[a]))
+        indices.append(inicio + int(areas.argmax()))
+    indices.append(n - 1)
+    return np.array(indices)
+
+# Config do Plotly para o velocímetro: puramente decorativo, sem interação nem barra de ferramentas
+CONFIG_GAUGE = {'staticPlot': True, 'displayModeBar': False}
+
+@st.cache_data(max_entries=64, show_spinner=False)
 def create_gauge_chart(score, title):
-    """Cria um gráfico de velocímetro para a nota (escala 2-10)."""
+    """Cria um gráfico de velocímetro para a nota (escala 2-10). Cacheado por (score, title)."""
     if score is None: score = 2.0
     fig = go.Figure(go.Indicator(
         mode="gauge+number", value=round(score, 2),
@@ -177,34 +522,36 @@ def create_gauge_chart(score, title):
     fig.update_layout(height=250, margin={'t':40, 'b':40, 'l':30, 'r':30})
     return fig
 
+# Escala de notas -> ratings
+RATING_POR_NOTA = {10: 'A+', 8: 'A', 6: 'A-', 4: 'B', 2: 'C'}
+
 def converter_nota_para_rating(nota):
     """Converte a nota (10, 8, 6, 4, 2) para o rating (A+ ... C)."""
-    nota = int(nota) # Garante que é int para comparação
-    if nota == 10: return 'A+'
-    elif nota == 8: return 'A'
-    elif nota == 6: return 'A-'
-    elif nota == 4: return 'B'
-    elif nota == 2: return 'C'
-    else: return "N/A"
+    # Sem int(): 8.0 e np.int64(8) têm o mesmo hash/igualdade que 8 e já encontram a chave
+    return RATING_POR_NOTA.get(nota, "N/A")
 
 def extrair_analise_mais_recente(historico_analises):
     """Encontra a análise mais recente no histórico."""
     if not historico_analises or not isinstance(historico_analises, dict):
         return None
     
-    # Tenta ordenar pelas chaves (ex: "2025-Q4"). A ordem alfabética funciona.
+    # A maior chave em ordem alfabética (ex: "2025-Q4") é a mais recente; max() dispensa ordenar
     try:
-        chave_recente = sorted(historico_analises.keys(), reverse=True)[0]
+        chave_recente = max(historico_analises)
         return historico_analises[chave_recente]
     except Exception:
         return None # Retorna None se o histórico estiver mal formatado
 
 class PDF(FPDF):
     """Classe de PDF personalizada para o relatório."""
+    def __init__(self, *args, logo=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.logo = logo # Bytes do logo (ou None)
+
     def header(self):
         try:
-            if os.path.exists("assets/seu_logo.png"):
-                self.image("assets/seu_logo.png", x=10, y=8, w=33)
+            if self.logo:
+                self.image(BytesIO(self.logo), x=10, y=8, w=33)
         except Exception:
             self.set_xy(10, 10)
             self.set_font('Arial', 'I', 8)
@@ -220,40 +567,47 @@ class PDF(FPDF):
         self.cell(0, 10, f'Página {self.page_no()}', 0, 0, 'C')
 
     def _write_text(self, text):
-        return str(text).encode('latin-1', 'replace').decode('latin-1')
+        text = text if isinstance(text, str) else str(text)
+        if text.isascii(): return text # Caso comum: nada a recodificar
+        return text.encode('latin-1', 'replace').decode('latin-1')
 
     def chapter_title(self, title):
         self.set_font('Arial', 'B', 14)
         self.multi_cell(0, 10, self._write_text(title), 0, 'L')
         self.ln(4)
 
-    def TabelaCadastro(self, ss):
+    def TabelaCadastro(self, dados):
         self.set_font('Arial', '', 10)
         line_height = self.font_size * 1.5
         col_width = self.epw / 4
         
-        data_emissao = ss.op_data_emissao
+        data_emissao = dados['op_data_emissao']
         if isinstance(data_emissao, datetime.datetime): data_emissao = data_emissao.date()
         
-        data_vencimento = ss.op_data_vencimento
+        data_vencimento = dados['op_data_vencimento']
         if isinstance(data_vencimento, datetime.datetime): data_vencimento = data_vencimento.date()
 
         data = {
-            "Nome da Operação:": ss.op_nome, "Código/Série:": ss.op_codigo,
-            "Volume Emitido:": f"R$ {ss.op_volume:,.2f}", "Taxa:": f"{ss.op_indexador} {ss.op_taxa}% a.a.",
+            "Nome da Operação:": dados['op_nome'], "Código/Série:": dados['op_codigo'],
+            "Volume Emitido:": f"R$ {dados['op_volume']:,.2f}", "Taxa:": f"{dados['op_indexador']} {dados['op_taxa']}% a.a.",
             "Data de Emissão:": data_emissao.strftime('%d/%m/%Y'), "Vencimento:": data_vencimento.strftime('%d/%m/%Y'),
-            "Emissor:": ss.op_emissor, "Tipo:": ss.op_tipo,
+            "Emissor:": dados['op_emissor'], "Tipo:": dados['op_tipo'],
         }
-        for i, (label, value) in enumerate(data.items()):
-            if i > 0 and i % 2 == 0: self.ln(line_height)
-            self.set_font('Arial', 'B', 10)
+        # Grade de 2 pares (rótulo, valor) por linha, escrita em duas passadas (rótulos em negrito,
+        # depois valores) para trocar de fonte só duas vezes em vez de duas por célula
+        x0, y0 = self.get_x(), self.get_y()
+        self.set_font('Arial', 'B', 10)
+        for i, label in enumerate(data):
+            self.set_xy(x0 + (i % 2) * 2 * col_width, y0 + (i // 2) * line_height)
             self.cell(col_width, line_height, self._write_text(label), border=1)
-            self.set_font('Arial', '', 10)
+        self.set_font('Arial', '', 10)
+        for i, value in enumerate(data.values()):
+            self.set_xy(x0 + ((i % 2) * 2 + 1) * col_width, y0 + (i // 2) * line_height)
             self.cell(col_width, line_height, self._write_text(str(value)), border=1)
-        self.ln(line_height)
+        self.set_xy(x0, y0 + -(-len(data) // 2) * line_height)
         self.ln(10)
 
-    def TabelaScorecard(self, ss, analise_ref):
+    def TabelaScorecard(self, dados, analise_ref):
         self.set_font('Arial', 'B', 10)
         line_height = self.font_size * 1.5
         col_widths = [self.epw * 0.4, self.epw * 0.15, self.epw * 0.15, self.epw * 0.15, self.epw * 0.15]
@@ -264,100 +618,81 @@ class PDF(FPDF):
         self.set_font('Arial', '', 10)
         
         # Pega a análise correta (a ativa)
-        scores = ss.scores_operacao
-        
-        nomes_inputs = {
-            'ltv': '1. LTV',
-            'demanda': '2. Demanda',
-            'behavior': '3. Behavior',
-            'comprometimento': '4. Comprometimento de Renda',
-            'inadimplencia': '5. Inadimplência'
-        }
+        scores = dados['scores_operacao']
         
-        for key, nome in nomes_inputs.items():
+        for key, nome in NOMES_INPUTS.items():
             nota = float(scores.get(key, 2)) # Garante que é float
             rating = converter_nota_para_rating(nota)
-            peso = 0.20
-            row = [nome, f"{peso*100:.0f}%", f"{nota:.0f}", rating, f"{nota * peso:.2f}"]
+            row = [nome, PESO_ATRIBUTO_TEXTO, f"{nota:.0f}", rating, f"{nota * PESO_ATRIBUTO:.2f}"]
             for i, item in enumerate(row): self.cell(col_widths[i], line_height, item, border=1, align='C')
             self.ln(line_height)
         self.ln(10)
 
-def gerar_relatorio_pdf(ss):
-    """Gera o PDF com os dados da análise ATIVA no session_state."""
-    try:
-        pdf = PDF()
-        pdf.add_page()
-        pdf.chapter_title('1. Dados Cadastrais da Operação')
-        pdf.TabelaCadastro(ss) # Usa dados cadastrais do session_state
-
-        analise_ref = ss.analise_ref_atual
-        pdf.chapter_title(f'2. Scorecard e Rating (Análise: {analise_ref})')
-        pdf.TabelaScorecard(ss, analise_ref) # Usa dados da análise ativa
-
-        resultados = ss.rating_final_operacao
-        nota_media = float(resultados.get('nota_media', 0))
-        rating_final = resultados.get('rating_final', 'N/A')
-
-        pdf.set_font('Arial', 'B', 12)
-        pdf.cell(0, 10, f"Score Médio Ponderado: {nota_media:.2f}", 0, 1)
-        pdf.cell(0, 10, f"Rating Final Atribuído: {rating_final}", 0, 1)
-        pdf.set_font('Arial', 'B', 10)
-        pdf.write(5, pdf._write_text(f"Justificativa: {ss.justificativa_final}"))
-        pdf.ln(10)
-
-        buffer = BytesIO()
-        pdf.output(buffer)
-        return buffer.getvalue()
+def gerar_relatorio_pdf(dados):
+    """
+    Gera o PDF com os dados da análise ATIVA (dict de coletar_dados_relatorio).
+    Erros são propagados (e não ficam no cache); quem chama decide como exibi-los.
+    """
+    pdf = PDF(logo=carregar_logo())
+    pdf.add_page()
+    pdf.chapter_title('1. Dados Cadastrais da Operação')
+    pdf.TabelaCadastro(dados) # Usa dados cadastrais
 
-    except Exception as e:
-        st.error(f"Ocorreu um erro crítico ao gerar o PDF: {e}")
-        st.exception(e) # Mostra o traceback completo
-        return b''
+    analise_ref = dados['analise_ref_atual']
+    pdf.chapter_title(f'2. Scorecard e Rating (Análise: {analise_ref})')
+    pdf.TabelaScorecard(dados, analise_ref) # Usa dados da análise ativa
+
+    resultados = dados['rating_final_operacao']
+    nota_media = float(resultados.get('nota_media', 0))
+    rating_final = resultados.get('rating_final', 'N/A')
+
+    pdf.set_font('Arial', 'B', 12)
+    pdf.cell(0, 10, f"Score Médio Ponderado: {nota_media:.2f}", 0, 1)
+    pdf.cell(0, 10, f"Rating Final Atribuído: {rating_final}", 0, 1)
+    pdf.set_font('Arial', 'B', 10)
+    pdf.write(5, pdf._write_text(f"Justificativa: {dados['justificativa_final']}"))
+    pdf.ln(10)
+
+    return bytes(pdf.output()) # fpdf2 devolve um bytearray quando não recebe destino
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _gerar_relatorio_pdf_cached(dados):
+    """Gera o PDF apenas quando os dados do relatório mudam (o dict é a chave do cache)."""
+    return gerar_relatorio_pdf(dados)
+
+def obter_relatorio_pdf():
+    """Retorna o PDF da análise ativa, reaproveitando o cache se os dados não mudaram."""
+    return _gerar_relatorio_pdf_cached(coletar_dados_relatorio())
 
 # ==============================================================================
 # FUNÇÕES DE CÁLCULO DE SCORE
 # ==============================================================================
 
-def calcular_nota_ltv(ltv):
-    ltv_perc = float(ltv)
-    if ltv_perc <= 60: return 10
-    elif ltv_perc <= 70: return 8
-    elif ltv_perc <= 80: return 6
-    elif ltv_perc <= 90: return 4
-    else: return 2
-
-def calcular_nota_demanda(demanda):
-    demanda = int(demanda)
-    if demanda > 200000: return 10
-    elif demanda >= 100000: return 8
-    elif demanda >= 50000: return 6
-    elif demanda >= 30000: return 4
-    else: return 2
-
-def calcular_nota_behavior(soma_behavior):
-    soma_behavior = int(soma_behavior)
-    if soma_behavior == 0: return 10
-    elif soma_behavior == 2: return 8
-    elif soma_behavior == 4: return 6
-    elif soma_behavior == 6: return 4
-    else: return 2 # > 6
-
-def calcular_nota_comprometimento(comprometimento):
-    comp_perc = float(comprometimento)
-    if comp_perc < 15: return 10
-    elif comp_perc <= 20: return 8
-    elif comp_perc <= 25: return 6
-    elif comp_perc <= 30: return 4
-    else: return 2 # > 30
-
-def calcular_nota_inadimplencia(soma_inad):
-    soma_inad = int(soma_inad)
-    if soma_inad == 0: return 10
-    elif soma_inad <= 4: return 8 # 0-4 (mas 0 já foi pego, então 1-4)
-    elif soma_inad <= 6: return 6 # 4-6 (mas >4, então 5-6)
-    elif soma_inad <= 8: return 4 # 6-8 (mas >6, então 7-8)
-    else: return 2 # > 8
+# Faixas de pontuação por atributo (linhas): a nota é NOTAS_FAIXAS[i][k], onde k é a
+# quantidade de limites de FAIXAS_LIMITES[i] que o valor ultrapassa (valor > limite).
+FAIXAS_LIMITES = np.array([
+    [60, 70, 80, 90],                         # LTV (%): <=60 | <=70 | <=80 | <=90 | >90
+    [29999, 49999, 99999, 200000],            # Demanda (int): <30000 | >=30000 | >=50000 | >=100000 | >200000
+    [0, 2, 4, 6],                             # Soma Behavior (sempre par): 0 | 2 | 4 | 6 | >6
+    [np.nextafter(15, -np.inf), 20, 25, 30],  # Comprometimento (%): <15 | <=20 | <=25 | <=30 | >30
+    [0, 4, 6, 8],                             # Soma Inadimplência: 0 | 1-4 | 5-6 | 7-8 | >8
+], dtype=float)
+NOTAS_FAIXAS = np.array([
+    [10, 8, 6, 4, 2],
+    [2, 4, 6, 8, 10],
+    [10, 8, 6, 4, 2],
+    [10, 8, 6, 4, 2],
+    [10, 8, 6, 4, 2],
+])
+
+def calcular_notas(valores):
+    """
+    Calcula as 5 notas de uma vez, sem desvios por atributo.
+    `valores` = [ltv, demanda, soma_behavior, comprometimento, soma_inad], ou uma matriz (N, 5).
+    As faixas de FAIXAS_LIMITES são a única definição dos limites de pontuação.
+    """
+    faixa = (np.asarray(valores, dtype=float)[..., None] > FAIXAS_LIMITES).sum(axis=-1)
+    return NOTAS_FAIXAS[np.arange(5), faixa]
 
 def calcular_rating(inputs):
     """
@@ -374,12 +709,14 @@ def calcular_rating(inputs):
                 (int(inputs.get('input_inad_60_90', 0)) * 4) + \
                 (int(inputs.get('input_inad_90_mais', 0)) * 6)
 
-    # 2. Calcular Notas Individuais
-    nota_ltv = calcular_nota_ltv(inputs.get('input_ltv', 999))
-    nota_demanda = calcular_nota_demanda(inputs.get('input_demanda', 0))
-    nota_behavior = calcular_nota_behavior(soma_behavior)
-    nota_comp = calcular_nota_comprometimento(inputs.get('input_comprometimento', 999))
-    nota_inad = calcular_nota_inadimplencia(soma_inad)
+    # 2. Calcular Notas Individuais (todas numa única operação vetorizada)
+    nota_ltv, nota_demanda, nota_behavior, nota_comp, nota_inad = calcular_notas([
+        float(inputs.get('input_ltv', 999)),
+        int(inputs.get('input_demanda', 0)),
+        soma_behavior,
+        float(inputs.get('input_comprometimento', 999)),
+        soma_inad,
+    ])
 
     # 3. Armazenar notas individuais (convertendo para tipos nativos)
     scores_operacao = {
@@ -394,12 +731,11 @@ def calcular_rating(inputs):
 
     # 4. Calcular Média Ponderada
     lista_notas = [nota_ltv, nota_demanda, nota_behavior, nota_comp, nota_inad]
-    nota_media = np.mean(lista_notas) # Média simples é igual a ponderada de 20%
+    nota_media = float(sum(lista_notas)) / 5 # Média simples é igual a ponderada de 20%
     
-    # 5. Mapear nota média para a nota final (10, 8, 6, 4, 2)
-    possible_scores = np.array([2, 4, 6, 8, 10])
-    idx = np.abs(possible_scores - float(nota_media)).argmin()
-    nota_final_arredondada = possible_scores[idx]
+    # 5. Mapear nota média para a nota final (10, 8, 6, 4, 2): o par mais próximo.
+    # A soma de 5 notas pares é par, então a média nunca fica equidistante de duas notas.
+    nota_final_arredondada = max(2, min(10, 2 * int(round(nota_media / 2))))
     
     rating_final = converter_nota_para_rating(nota_final_arredondada)
 
@@ -412,6 +748,45 @@ def calcular_rating(inputs):
     
     return scores_operacao, rating_final_operacao
 
+def calcular_rating_batch(df_inputs):
+    """
+    Versão vetorizada de calcular_rating para várias operações de uma vez (ex: recalcular o painel).
+    Recebe um DataFrame com as colunas 'input_*' (uma linha por operação) e retorna um DataFrame
+    com as notas, as somas de penalização e o resultado final, no mesmo índice.
+    """
+    n = len(df_inputs)
+    def coluna(key, padrao):
+        return df_inputs[key].to_numpy() if key in df_inputs else np.full(n, padrao)
+
+    # 1. Somas de Penalização
+    soma_behavior = (coluna('input_behavior_30_60', 0).astype(int) * 2 +
+                     coluna('input_behavior_60_90', 0).astype(int) * 4 +
+                     coluna('input_behavior_90_mais', 0).astype(int) * 6)
+    soma_inad = (coluna('input_inad_30_60', 0).astype(int) * 2 +
+                 coluna('input_inad_60_90', 0).astype(int) * 4 +
+                 coluna('input_inad_90_mais', 0).astype(int) * 6)
+
+    # 2. Notas individuais: matriz (N, 5) numa única chamada
+    notas = calcular_notas(np.column_stack([
+        coluna('input_ltv', 999).astype(float),
+        coluna('input_demanda', 0).astype(int),
+        soma_behavior,
+        coluna('input_comprometimento', 999).astype(float),
+        soma_inad,
+    ]))
+
+    # 3. Média e nota final (par mais próximo, como em calcular_rating)
+    nota_media = notas.sum(axis=1) / 5
+    nota_final = np.clip(2 * np.round(nota_media / 2), 2, 10).astype(int)
+
+    resultado = pd.DataFrame(notas, columns=list(NOMES_INPUTS), index=df_inputs.index)
+    resultado['soma_behavior'] = soma_behavior
+    resultado['soma_inad'] = soma_inad
+    resultado['nota_media'] = nota_media
+    resultado['nota_final'] = nota_final
+    resultado['rating_final'] = [converter_nota_para_rating(nota) for nota in nota_final]
+    return resultado
+
 # ==============================================================================
 # CALLBACKS DE NAVEGAÇÃO E AÇÕES
 # ==============================================================================
@@ -440,8 +815,47 @@ def callback_nova_operacao():
     st.session_state.analise_ref_atual = "" # Força o usuário a digitar
     st.session_state.pagina_atual = "analise"
 
-def callback_selecionar_operacao(op_id, op_data):
-    """(Do Painel -> Detalhe) Carrega dados de uma op para a página de DETALHE."""
+def carregar_historico(db, op_id):
+    """
+    Carrega o histórico de análises de uma operação a partir da subcoleção.
+    Operações antigas guardavam o histórico num campo-mapa do documento; por isso o campo
+    legado (se existir) é mesclado, com a subcoleção prevalecendo.
+    Retorna (None, {}) se a operação não existe mais (ex: excluída por outra sessão).
+    """
+    doc_ref = db.collection(DB_COLLECTION).document(op_id)
+    snapshot = doc_ref.get()
+    if not snapshot.exists:
+        return None, {}
+    op_data = snapshot.to_dict() or {}
+
+    historico_legado = op_data.pop('historico_analises', None)
+    historico = dict(historico_legado) if isinstance(historico_legado, dict) else {}
+    for analise in doc_ref.collection(DB_SUBCOLLECTION_HISTORICO).stream():
+        historico[analise.id] = analise.to_dict()
+    return op_data, historico
+
+def callback_selecionar_operacao(op_id):
+    """
+    (Do Painel -> Detalhe) Carrega dados de uma op para a página de DETALHE.
+    Retorna True se trocou de página; False (com a mensagem de erro já exibida) caso contrário.
+    """
+    # O painel só tem os campos projetados; busca o documento completo e o histórico aqui
+    db = get_firestore_client()
+    if db is None: return False
+
+    try:
+        op_data, historico = carregar_historico(db, op_id)
+    except Exception as e:
+        st.error(f"Erro ao carregar operação: {e}")
+        return False
+
+    if op_data is None:
+        # O painel pode estar defasado (cache): não abre o detalhe com os valores padrão,
+        # o que recriaria a operação ao salvar. Força recarregar a lista
+        st.error("Esta operação não existe mais (pode ter sido excluída em outra sessão). A lista será atualizada.")
+        invalidar_cache_db()
+        return False
+
     # Limpa TUDO primeiro para garantir um estado limpo
     limpar_formulario_cadastro() 
     limpar_formulario_analise()
@@ -449,18 +863,15 @@ def callback_selecionar_operacao(op_id, op_data):
     
     st.session_state.pagina_atual = "detalhe"
     st.session_state.operacao_selecionada_id = op_id
+    st.session_state.historico_analises = historico
 
-    # Carrega todos os dados do banco para o session_state
-    for key, value in op_data.items():
-        if key == 'historico_analises':
-             st.session_state.historico_analises = value if isinstance(value, dict) else {}
-        
-        elif key in DEFAULTS_CADASTRO:
-            # Converte timestamps do Firestore de volta para datetime.date
-            if key in ['op_data_emissao', 'op_data_vencimento'] and isinstance(value, datetime.datetime):
-                st.session_state[key] = value.date()
-            else:
-                st.session_state[key] = value
+    # Carrega os dados cadastrais do banco para o session_state
+    st.session_state.update({key: value for key, value in op_data.items() if key in DEFAULTS_CADASTRO})
+    # Converte timestamps do Firestore de volta para datetime.date
+    for key in CAMPOS_DATA & op_data.keys():
+        if isinstance(op_data[key], datetime.datetime):
+            st.session_state[key] = op_data[key].date()
+    return True
 
 def callback_ir_para_analise(analise_ref_para_editar):
     """(Do Detalhe -> Análise) Prepara o editor para criar ou editar uma análise."""
@@ -507,12 +918,45 @@ def callback_deletar_operacao(op_id):
     if db is None: return
         
     try:
-        db.collection(DB_COLLECTION).document(op_id).delete()
+        doc_ref = db.collection(DB_COLLECTION).document(op_id)
+        versao = versao_ouvinte()
+
+        # Subcoleções não são apagadas junto com o documento: remove o histórico no mesmo batch
+        batch, n_ops = db.batch(), 0
+        for analise in doc_ref.collection(DB_SUBCOLLECTION_HISTORICO).select([]).stream():
+            batch.delete(analise.reference)
+            n_ops += 1
+            if n_ops == 499: # Limite de 500 operações por batch
+                batch.commit()
+                batch, n_ops = db.batch(), 0
+        batch.delete(doc_ref)
+        batch.commit()
+
         st.toast(f"Operação {op_id} deletada.", icon="🗑️")
-        carregar_db.clear() # Limpa o cache para forçar recarregar
+        invalidar_cache_db(versao) # Limpa o cache para forçar recarregar
     except Exception as e:
         st.error(f"Erro ao deletar operação: {e}")
 
+def callback_gerar_pdf():
+    """(Da Análise) Gera o PDF do preview sob demanda e guarda junto com os dados usados."""
+    # Recalcula com os inputs atuais: podem ter mudado desde a última renderização
+    scores, resultados = calcular_rating(coletar_inputs_da_sessao())
+    st.session_state.scores_operacao = scores
+    st.session_state.rating_final_operacao = resultados
+    
+    dados = coletar_dados_relatorio()
+    try:
+        pdf = obter_relatorio_pdf()
+    except Exception as e:
+        # Nada é guardado: o download continua desabilitado e um novo clique tenta de novo
+        st.session_state.pop('pdf_relatorio', None)
+        st.error(f"Ocorreu um erro crítico ao gerar o PDF: {e}")
+        st.exception(e) # Mostra o traceback completo
+        return
+    # O nome do arquivo depende só de `dados`, então é montado aqui uma vez, junto com o PDF
+    nome = f"Relatorio_CCI_{dados['op_nome'].replace(' ', '_')}_{dados['analise_ref_atual']}.pdf"
+    st.session_state.pdf_relatorio = (dados, pdf, nome)
+
 def callback_calcular_e_salvar():
     """(Da Análise) Calcula o rating e salva a análise no histórico da operação."""
     
@@ -526,16 +970,16 @@ def callback_calcular_e_salvar():
     if not analise_ref or len(analise_ref.strip()) < 4:
         st.error("Erro: A 'Referência da Análise' (Ex: 2025-Q4) é obrigatória.")
         return
+    if '/' in analise_ref:
+        st.error("Erro: A 'Referência da Análise' não pode conter '/'.")
+        return
 
     # --- 2. Coletar Dados Estáticos (Cadastro) ---
     # Isso garante que os dados de cadastro sejam salvos/atualizados na primeira vez
     dados_para_salvar = coletar_dados_estaticos_da_sessao()
     
     # --- 3. Calcular a Análise ---
-    inputs_atuais = {}
-    for key in DEFAULTS_ANALISE.keys():
-        if key.startswith('input_'):
-            inputs_atuais[key] = st.session_state[key]
+    inputs_atuais = coletar_inputs_da_sessao()
             
     scores_calc, resultados_calc = calcular_rating(inputs_atuais)
     
@@ -559,16 +1003,24 @@ def callback_calcular_e_salvar():
     try:
         doc_ref = db.collection(DB_COLLECTION).document(op_id)
         
-        # Usa 'set' com 'merge=True' para salvar/atualizar os dados cadastrais
-        # E usa 'set' com 'merge=True' para adicionar/atualizar a análise no histórico
-        dados_para_salvar['historico_analises'] = {
-            analise_ref: pacote_analise
-        }
+        # A análise vai para a subcoleção de histórico: o documento da operação não cresce
+        # e cada salvamento não retransmite as análises anteriores
+        analise_ref_doc = doc_ref.collection(DB_SUBCOLLECTION_HISTORICO).document(analise_ref)
         
-        doc_ref.set(dados_para_salvar, merge=True) # merge=True é crucial
+        # Resumo da análise mais recente, lido pelo painel sem baixar o histórico
+        historico_atualizado = dict(st.session_state.get('historico_analises') or {})
+        historico_atualizado[analise_ref] = pacote_analise
+        dados_para_salvar['rating_final_operacao'] = extrair_analise_mais_recente(historico_atualizado)['resultados']
+        
+        # Todas as gravações do salvamento vão num único WriteBatch (um commit/RTT)
+        versao = versao_ouvinte()
+        batch = db.batch()
+        batch.set(doc_ref, dados_para_salvar, merge=True) # merge=True é crucial (dados cadastrais)
+        batch.set(analise_ref_doc, pacote_analise) # Cria/substitui a análise no histórico
+        batch.commit()
         
         # Limpa o cache do DB para que o painel e o detalhe sejam atualizados
-        carregar_db.clear()
+        invalidar_cache_db(versao)
         
         # Atualiza o histórico no session_state local
         if 'historico_analises' not in st.session_state or not isinstance(st.session_state.historico_analises, dict):
@@ -588,53 +1040,77 @@ def callback_calcular_e_salvar():
 # RENDERIZAÇÃO DAS PÁGINAS (Views)
 # ==============================================================================
 
-def renderizar_tabela_operacoes(operacoes_filtradas):
-    """Função auxiliar para renderizar a tabela no painel."""
+# Estilo CSS de cada rating na tabela do painel (montado uma vez)
+ESTILO_RATING = {
+    rating: f'color: {cor}; font-weight: bold'
+    for rating, cor in [('A+', 'green'), ('A', 'green'), ('A-', 'green'), ('B', 'orange'), ('C', 'red')]
+}
+
+def cor_rating(rating):
+    """Estilo CSS do rating para a tabela do painel ('' para ratings desconhecidos, ex: N/A)."""
+    return ESTILO_RATING.get(rating, '')
+
+@st.fragment
+def renderizar_tabela_operacoes(operacoes_filtradas, grupo):
+    """
+    Função auxiliar para renderizar a tabela no painel: um único st.dataframe com seleção de linha.
+    É um fragmento, então selecionar uma linha reexecuta só a tabela.
+    """
     
     if not operacoes_filtradas:
         st.info("Nenhuma operação cadastrada neste grupo.")
         return
-        
-    # Define as colunas do painel
-    col1, col2, col3, col4, col5 = st.columns([3, 2, 1, 1, 1])
-    col1.markdown("**Nome da Operação**")
-    col2.markdown("**Código**")
-    col3.markdown("**Rating (Último)**")
-    col4.markdown("**Ação**")
-    col5.markdown("**Excluir**")
-
-    # Itera e exibe cada operação
-    for op_id, op_data in operacoes_filtradas:
-        op_nome = op_data.get('op_nome', 'Sem Nome')
-        op_codigo = op_data.get('op_codigo', 'N/A')
-        
-        # Pega o rating final da análise mais recente
-        historico = op_data.get('historico_analises', {})
-        analise_recente = extrair_analise_mais_recente(historico)
-        
-        if analise_recente:
-            rating_final = analise_recente.get('resultados', {}).get('rating_final', 'N/A')
-        else:
-            rating_final = 'N/A'
-        
-        with st.container():
-            c1, c2, c3, c4, c5 = st.columns([3, 2, 1, 1, 1])
-            c1.write(op_nome)
-            c2.write(op_codigo)
-            
-            # Adiciona cor ao rating
-            if rating_final.startswith('A'):
-                c3.markdown(f"**<span style='color:green;'>{rating_final}</span>**", unsafe_allow_html=True)
-            elif rating_final == 'B':
-                c3.markdown(f"**<span style='color:orange;'>{rating_final}</span>**", unsafe_allow_html=True)
-            elif rating_final == 'C':
-                c3.markdown(f"**<span style='color:red;'>{rating_final}</span>**", unsafe_allow_html=True)
-            else:
-                c3.write(rating_final)
-
-            # Botões de Ação
-            c4.button("Analisar", key=f"analisar_{op_id}", on_click=callback_selecionar_operacao, args=(op_id, op_data), use_container_width=True)
-            c5.button("🗑️", key=f"deletar_{op_id}", on_click=callback_deletar_operacao, args=(op_id,), use_container_width=True, help="Deletar operação")
+
+    ids = [op_id for op_id, _ in operacoes_filtradas]
+    df_ops = pd.DataFrame({
+        'Nome da Operação': [op_data.get('op_nome', 'Sem Nome') for _, op_data in operacoes_filtradas],
+        'Código': [op_data.get('op_codigo', 'N/A') for _, op_data in operacoes_filtradas],
+        # Rating da análise mais recente (resumo salvo no documento)
+        'Rating (Último)': [(op_data.get('rating_final_operacao') or {}).get('rating_final', 'N/A') for _, op_data in operacoes_filtradas],
+    })
+
+    # A seleção é um índice de linha: a key muda com a lista de ids (inclusive por gravações
+    # de outras sessões) e com a versão do DB, para a seleção nunca apontar para outra operação
+    assinatura = hashlib.md5('\0'.join(ids).encode()).hexdigest()[:12]
+    evento = st.dataframe(
+        df_ops.style.map(cor_rating, subset=['Rating (Último)']),
+        key=f"tabela_{grupo}_{st.session_state.get('db_versao', 0)}_{assinatura}",
+        on_select="rerun", selection_mode="single-row",
+        hide_index=True, use_container_width=True,
+        column_config={
+            'Nome da Operação': st.column_config.TextColumn(width='large'),
+            'Código': st.column_config.TextColumn(width='medium'),
+            'Rating (Último)': st.column_config.TextColumn(width='small'),
+        },
+    )
+
+    linhas = evento.selection.rows
+    if not linhas or linhas[0] >= len(ids):
+        st.caption("Selecione uma operação na tabela para analisar ou excluir.")
+        return
+
+    op_id = ids[linhas[0]]
+    nome = df_ops['Nome da Operação'].iat[linhas[0]]
+    chave_confirmacao = f"confirmar_exclusao_{grupo}"
+    c1, c2 = st.columns([3, 1])
+    # Botões de Ação (trocam de página/alteram a lista: reexecutam o app inteiro)
+    if c1.button(f"Analisar: {nome}", key=f"analisar_{grupo}", type="primary", use_container_width=True):
+        # Em caso de erro fica no painel, para a mensagem continuar visível
+        if callback_selecionar_operacao(op_id):
+            st.rerun()
+    if c2.button(f"🗑️ Excluir: {nome}", key=f"deletar_{grupo}", use_container_width=True, help="Deletar operação"):
+        # Guarda o id (não a linha): a exclusão só acontece após a confirmação abaixo
+        st.session_state[chave_confirmacao] = op_id
+
+    if st.session_state.get(chave_confirmacao) == op_id:
+        st.warning(f"Excluir a operação **{nome}** e todo o seu histórico? Esta ação não pode ser desfeita.")
+        c_sim, c_nao = st.columns(2)
+        if c_sim.button("Confirmar exclusão", key=f"confirmar_deletar_{grupo}", type="primary", use_container_width=True):
+            callback_deletar_operacao(st.session_state.pop(chave_confirmacao))
+            st.rerun()
+        if c_nao.button("Cancelar", key=f"cancelar_deletar_{grupo}", use_container_width=True):
+            st.session_state.pop(chave_confirmacao, None)
+            st.rerun()
 
 def renderizar_painel():
     """Renderiza o painel principal com a lista de operações."""
@@ -646,20 +1122,23 @@ def renderizar_painel():
 
     st.divider()
     
-    db_data = carregar_db()
+    painel = carregar_db()
     
-    if not db_data:
+    if not painel.operacoes:
         st.info("Nenhuma operação cadastrada. Clique em 'Cadastrar Nova Operação' para começar.")
         return
 
-    # Filtra operações
-    ops_internas = []
-    ops_externas = []
-    for op_id, op_data in db_data.items():
-        if op_data.get('op_tipo', 'Interna') == 'Interna':
-            ops_internas.append((op_id, op_data))
-        else:
-            ops_externas.append((op_id, op_data))
+    # Totais dos mesmos dados das tabelas (listener ou cache), sem consultas extras
+    resumo = resumo_painel(painel)
+    colunas = st.columns(3 + len(resumo['por_rating']))
+    colunas[0].metric("Operações", resumo['total'])
+    colunas[1].metric("Volume Total (R$)", f"R$ {resumo['volume']:,.2f}")
+    for coluna, (rating, total) in zip(colunas[2:], resumo['por_rating'].items()):
+        coluna.metric(f"Rating {rating}", total)
+    colunas[-1].metric("Sem Rating", resumo['sem_rating'])
+
+    # Partição já montada quando os dados mudaram (listener/cache), não a cada rerun
+    ops_internas, ops_externas = painel.internas, painel.externas
             
     # Cria abas para os tipos
     tab_int, tab_ext = st.tabs([
@@ -668,10 +1147,10 @@ def renderizar_painel():
     ])
     
     with tab_int:
-        renderizar_tabela_operacoes(ops_internas)
+        renderizar_tabela_operacoes(ops_internas, "internas")
         
     with tab_ext:
-        renderizar_tabela_operacoes(ops_externas)
+        renderizar_tabela_operacoes(ops_externas, "externas")
             
     st.divider()
 
@@ -732,7 +1211,7 @@ def renderizar_detalhe_operacao():
     
     col_gauge, col_metrics = st.columns([2, 1])
     with col_gauge:
-        st.plotly_chart(create_gauge_chart(nota_media, "Score Médio Ponderado (Última Análise)"), use_container_width=True)
+        st.plotly_chart(create_gauge_chart(nota_media, "Score Médio Ponderado (Última Análise)"), use_container_width=True, config=CONFIG_GAUGE)
     with col_metrics:
         st.metric("Score Médio (0-10)", f"{nota_media:.2f}")
         st.metric("Rating Final Atribuído", rating_final)
@@ -741,28 +1220,32 @@ def renderizar_detalhe_operacao():
     
     # --- Seção do Histórico ---
     st.subheader("Histórico de Análises")
+    refs_ordenadas = sorted(historico) # Ordem alfabética = cronológica, como em extrair_analise_mais_recente
     
-    if len(historico) > 0:
-        # Prepara dados para o gráfico
-        data_grafico = []
-        for ref, analise in historico.items():
-            data_grafico.append({
-                "Referência": ref,
-                "Nota Média": float(analise.get('resultados', {}).get('nota_media', 0)),
-                "Rating": analise.get('resultados', {}).get('rating_final', 'N/A')
-            })
-        
-        # Ordena pela Referência (ex: 2024-Q4, 2025-Q1)
-        df_grafico = pd.DataFrame(data_grafico).sort_values(by="Referência")
+    if len(historico) > 1:
+        # Prepara dados para o gráfico (só quando há o que plotar)
+        # Listas já na ordem das Referências (ex: 2024-Q4, 2025-Q1), sem montar/ordenar um DataFrame
+        resultados_grafico = [historico[ref].get('resultados', {}) for ref in refs_ordenadas]
+        refs_grafico = refs_ordenadas
+        notas_grafico = [float(r.get('nota_media', 0)) for r in resultados_grafico]
+        ratings_grafico = [r.get('rating_final', 'N/A') for r in resultados_grafico]
+        # Históricos longos: envia só os pontos que preservam o formato da curva
+        if len(notas_grafico) > LIMITE_PONTOS_GRAFICO:
+            indices = indices_lttb(notas_grafico, LIMITE_PONTOS_GRAFICO)
+            refs_grafico = [refs_grafico[i] for i in indices]
+            notas_grafico = [notas_grafico[i] for i in indices]
+            ratings_grafico = [ratings_grafico[i] for i in indices]
         
         # Gráfico de Linha
-        if len(df_grafico) > 1:
-            fig = px.line(df_grafico, x="Referência", y="Nota Média", title="Evolução da Nota Média da Operação",
-                          text="Rating", markers=True)
-            fig.update_traces(textposition="top center")
-            st.plotly_chart(fig, use_container_width=True)
-        else:
-             st.info("Apenas uma análise registrada. O gráfico de evolução será exibido quando houver 2 ou mais análises.")
+        fig = px.line(x=refs_grafico, y=notas_grafico, text=ratings_grafico,
+                      labels={'x': "Referência", 'y': "Nota Média", 'text': "Rating"},
+                      title="Evolução da Nota Média da Operação", markers=True)
+        fig.update_traces(textposition="top center")
+        fig.update_layout(uirevision="historico") # Mantém zoom/pan do usuário entre reruns
+        st.plotly_chart(fig, use_container_width=True)
+
+    elif historico:
+        st.info("Apenas uma análise registrada. O gráfico de evolução será exibido quando houver 2 ou mais análises.")
 
     else:
         st.info("Nenhuma análise registrada para esta operação.")
@@ -782,8 +1265,7 @@ def renderizar_detalhe_operacao():
     if historico:
         col_edit = st.columns(4)
         i = 0
-        refs_ordenadas = sorted(historico.keys(), reverse=True) # Mais recentes primeiro
-        for ref in refs_ordenadas:
+        for ref in reversed(refs_ordenadas): # Mais recentes primeiro
             col = col_edit[i % 4]
             col.button(f"Editar {ref}", key=f"edit_{ref}", on_click=callback_ir_para_analise, args=(ref,), use_container_width=True)
             i += 1
@@ -791,6 +1273,80 @@ def renderizar_detalhe_operacao():
         st.caption("Nenhuma análise para editar.")
 
 
+@st.fragment
+def renderizar_preview_resultado():
+    """
+    Aba de Resultado (Preview). Como fragmento, os botões daqui (ex: gerar o PDF) reexecutam
+    só esta aba; mudanças nos inputs das outras abas continuam reexecutando a página toda.
+    """
+    st.header("Resultado da Análise (Preview)")
+    st.warning("Este é um preview. Os dados só serão salvos permanentemente quando você clicar em 'Calcular e Salvar Análise' na aba 'Inputs'.")
+    
+    # Pega os inputs atuais
+    inputs_preview = coletar_inputs_da_sessao()
+    
+    # Calcula o preview
+    scores_preview, resultados_preview = calcular_rating(inputs_preview)
+        
+    st.subheader("Scorecard Mestre (Preview)")
+    
+    notas = [float(scores_preview.get(key, 2)) for key in NOMES_INPUTS]
+    # Monta o DataFrame por colunas (evita a inferência de tipos linha a linha)
+    df_scores = pd.DataFrame({
+        'Atributo': list(NOMES_INPUTS.values()),
+        'Peso': [PESO_ATRIBUTO_TEXTO] * len(notas),
+        'Nota (2-10)': notas,
+        'Rating': [converter_nota_para_rating(nota) for nota in notas],
+        'Score Ponderado': [f"{nota * PESO_ATRIBUTO:.2f}" for nota in notas],
+    })
+    st.dataframe(
+        df_scores, hide_index=True, use_container_width=True,
+        column_config={
+            'Atributo': st.column_config.TextColumn(width='large'),
+            'Peso': st.column_config.TextColumn(width='small'),
+            'Nota (2-10)': st.column_config.NumberColumn(format="%.0f", width='small'),
+            'Rating': st.column_config.TextColumn(width='small'),
+            'Score Ponderado': st.column_config.TextColumn(width='small'),
+        },
+    )
+    st.divider()
+    
+    nota_media = float(resultados_preview.get('nota_media', 0))
+    nota_final = float(resultados_preview.get('nota_final', 0))
+    rating_final = resultados_preview.get('rating_final', 'N/A')
+    
+    st.subheader("Resultado Final Ponderado (Preview)")
+    col_gauge, col_metrics = st.columns([2, 1])
+    
+    with col_gauge:
+        st.plotly_chart(create_gauge_chart(nota_media, "Score Médio Ponderado"), use_container_width=True, config=CONFIG_GAUGE)
+    with col_metrics:
+        st.metric("Score Médio (0-10)", f"{nota_media:.2f}")
+        st.metric("Nota Final (Mais Próxima)", f"{nota_final:.0f}")
+        st.metric("Rating Final Atribuído", rating_final)
+    
+    st.info(f"Somas de Penalização (Referência): Behavior = {int(scores_preview.get('soma_behavior', 0))}, Inadimplência = {int(scores_preview.get('soma_inad', 0))}")
+    st.divider()
+
+    st.subheader("⬇️ Download do Relatório (Preview)")
+    st.warning("O PDF será gerado com os dados *atualmente em tela* (preview).")
+    
+    # Atualiza o state com os dados de preview para o PDF
+    ss = st.session_state # Acessa o proxy do session_state uma única vez
+    ss.scores_operacao = scores_preview
+    ss.rating_final_operacao = resultados_preview
+    
+    # O PDF só é gerado ao clicar em "Gerar"; o download fica liberado enquanto os dados não mudarem
+    pdf_gerado = ss.get('pdf_relatorio')
+    pdf_atual = pdf_gerado is not None and bool(pdf_gerado[1]) and pdf_gerado[0] == coletar_dados_relatorio()
+    c_gerar, c_baixar = st.columns(2)
+    c_gerar.button("Gerar Relatório (Preview) em PDF", on_click=callback_gerar_pdf, use_container_width=True)
+    c_baixar.download_button(
+        label="Baixar Relatório (Preview) em PDF", data=pdf_gerado[1] if pdf_atual else b'',
+        file_name=pdf_gerado[2] if pdf_atual else None, disabled=not pdf_atual, on_click="ignore", # Baixar não precisa reexecutar nada
+        mime="application/pdf", use_container_width=True
+    )
+
 def renderizar_analise():
     """Renderiza a página de análise (abas de cadastro, inputs, resultado)."""
     
@@ -876,43 +1432,36 @@ def renderizar_analise():
         st.header("Inputs para o Rating")
         st.info("Estes dados são específicos para esta análise.")
         
-        # Campo obrigatório para a referência da análise
-        st.text_input(
-            "**Referência da Análise (Obrigatório)**", 
-            key='analise_ref_atual',
-            help="Ex: 2025-Q1, 2024-Q4, etc. Esta será a chave para salvar no histórico."
-        )
-        st.divider()
-
-        col1, col2 = st.columns(2)
-        with col1:
-            with st.container(border=True):
-                st.subheader("1. LTV (Loan-to-Value)")
-                st.number_input("LTV da operação (%)", key='input_ltv', min_value=0.0, max_value=200.0, step=1.0, format="%.2f")
-            with st.container(border=True):
-                st.subheader("2. Demanda")
-                st.number_input("Valor da Demanda (Ex: R$)", key='input_demanda', min_value=0, step=1000)
-            with st.container(border=True):
-                st.subheader("3. Behavior (Penalização)")
-                st.number_input("Qtd. Atrasos 30-60 dias", key='input_behavior_30_60', min_value=0, step=1)
-                st.number_input("Qtd. Atrasos 60-90 dias", key='input_behavior_60_90', min_value=0, step=1)
-                st.number_input("Qtd. Atrasos >90 dias", key='input_behavior_90_mais', min_value=0, step=1)
-        with col2:
-            with st.container(border=True):
-                st.subheader("4. Comprometimento de Renda")
-                st.number_input("Comprometimento de Renda (%)", key='input_comprometimento', min_value=0.0, max_value=100.0, step=0.5, format="%.2f")
-            with st.container(border=True):
-                st.subheader("5. Inadimplência (Penalização)")
-                st.number_input("Qtd. Inad. 30-60 dias", key='input_inad_30_60', min_value=0, step=1)
-                st.number_input("Qtd. Inad. 60-90 dias", key='input_inad_60_90', min_value=0, step=1)
-                st.number_input("Qtd. Inad. >90 dias", key='input_inad_90_mais', min_value=0, step=1)
-        
-        st.divider()
-        st.text_area("Justificativa e comentários finais (opcional):", height=100, key='justificativa_final')
-        st.divider()
+        # Formulário: digitar nos inputs não reexecuta o script; os valores só são aplicados
+        # (e o preview recalculado) ao clicar em um dos botões de envio
+        with st.form("form_inputs_analise", border=False):
+            # Campo obrigatório para a referência da análise
+            st.text_input(
+                "**Referência da Análise (Obrigatório)**", 
+                key='analise_ref_atual',
+                help="Ex: 2025-Q1, 2024-Q4, etc. Esta será a chave para salvar no histórico."
+            )
+            st.divider()
+
+            colunas = st.columns(2)
+            for coluna, secoes in zip(colunas, ESQUEMA_INPUTS):
+                with coluna:
+                    for titulo, campos in secoes:
+                        with st.container(border=True):
+                            st.subheader(titulo)
+                            for key, label, opcoes in campos:
+                                st.number_input(label, key=key, **opcoes)
         
+            st.divider()
+            st.text_area("Justificativa e comentários finais (opcional):", height=100, key='justificativa_final')
+            st.divider()
+            
+            c_preview, c_salvar = st.columns(2)
+            c_preview.form_submit_button("Atualizar Preview", use_container_width=True)
+            salvar = c_salvar.form_submit_button("Calcular e Salvar Análise", use_container_width=True, type="primary")
+
         # Botão de Salvar
-        if st.button("Calcular e Salvar Análise", use_container_width=True, type="primary"):
+        if salvar:
             callback_calcular_e_salvar()
             # Se o callback for bem-sucedido, ele mesmo mudará a página
             # Se falhar (ex: validação), ele mostrará um erro e ficará nesta página
@@ -921,69 +1470,7 @@ def renderizar_analise():
 
     # --- ABA 2: RESULTADO (PREVIEW) ---
     with tab_res:
-        st.header("Resultado da Análise (Preview)")
-        st.warning("Este é um preview. Os dados só serão salvos permanentemente quando você clicar em 'Calcular e Salvar Análise' na aba 'Inputs'.")
-        
-        # Pega os inputs atuais
-        inputs_preview = {}
-        for key in DEFAULTS_ANALISE.keys():
-            if key.startswith('input_'):
-                inputs_preview[key] = st.session_state[key]
-        
-        # Calcula o preview
-        scores_preview, resultados_preview = calcular_rating(inputs_preview)
-            
-        st.subheader("Scorecard Mestre (Preview)")
-        
-        nomes_inputs = {
-            'ltv': '1. LTV', 'demanda': '2. Demanda', 'behavior': '3. Behavior',
-            'comprometimento': '4. Comprometimento de Renda', 'inadimplencia': '5. Inadimplência'
-        }
-        data = []
-        for key, nome in nomes_inputs.items():
-            nota = float(scores_preview.get(key, 2))
-            rating_input = converter_nota_para_rating(nota)
-            peso = 0.20
-            data.append({
-                'Atributo': nome, 'Peso': f"{peso*100:.0f}%", 'Nota (2-10)': nota,
-                'Rating': rating_input, 'Score Ponderado': f"{nota * peso:.2f}"
-            })
-        
-        df_scores = pd.DataFrame(data).set_index('Atributo')
-        st.table(df_scores)
-        st.divider()
-        
-        nota_media = float(resultados_preview.get('nota_media', 0))
-        nota_final = float(resultados_preview.get('nota_final', 0))
-        rating_final = resultados_preview.get('rating_final', 'N/A')
-        
-        st.subheader("Resultado Final Ponderado (Preview)")
-        col_gauge, col_metrics = st.columns([2, 1])
-        
-        with col_gauge:
-            st.plotly_chart(create_gauge_chart(nota_media, "Score Médio Ponderado"), use_container_width=True)
-        with col_metrics:
-            st.metric("Score Médio (0-10)", f"{nota_media:.2f}")
-            st.metric("Nota Final (Mais Próxima)", f"{nota_final:.0f}")
-            st.metric("Rating Final Atribuído", rating_final)
-        
-        st.info(f"Somas de Penalização (Referência): Behavior = {int(scores_preview.get('soma_behavior', 0))}, Inadimplência = {int(scores_preview.get('soma_inad', 0))}")
-        st.divider()
-
-        st.subheader("⬇️ Download do Relatório (Preview)")
-        st.warning("O PDF será gerado com os dados *atualmente em tela* (preview).")
-        
-        # Atualiza o state com os dados de preview para o PDF
-        st.session_state.scores_operacao = scores_preview
-        st.session_state.rating_final_operacao = resultados_preview
-        
-        pdf_data = gerar_relatorio_pdf(st.session_state)
-        pdf_nome = f"Relatorio_CCI_{st.session_state.op_nome.replace(' ', '_')}_{st.session_state.analise_ref_atual}.pdf"
-        st.download_button(
-            label="Baixar Relatório (Preview) em PDF", data=pdf_data,
-            file_name=pdf_nome,
-            mime="application/pdf", use_container_width=True
-        )
+        renderizar_preview_resultado()
 
     # --- ABA 3: METODOLOGIA ---
     with tab_met:
@@ -1020,8 +1507,9 @@ st.set_page_config(layout="wide", page_title="Rating de CCIs")
 # Renderização do cabeçalho
 col1, col2 = st.columns([1, 3])
 with col1:
-    if os.path.exists("assets/seu_logo.png"):
-        st.image("assets/seu_logo.png", use_container_width=True)
+    logo = carregar_logo()
+    if logo:
+        st.image(logo, use_container_width=True)
     else:
         st.caption("Seu Logo Aqui")
 with col2:
@@ -0,0 +1,124 @@
+"""
+Migração única das operações salvas no formato antigo da coleção `cci_operacoes`.
+
+- Operações sem o resumo `rating_final_operacao` recebem o resultado da análise mais
+  recente do histórico, para o painel não mostrar N/A. Sem análise, recebem {}.
+- Operações com o histórico no campo-mapa `historico_analises` têm as análises copiadas
+  para a subcoleção `historico`. As que já existem lá são mantidas (a subcoleção prevalece,
+  como em carregar_historico do app). Depois o campo é removido, e o listener do painel
+  deixa de baixar o histórico inteiro.
+
+Cada operação é migrada numa transação, que relê o documento e a subcoleção. Uma
+gravação feita pelo app durante a migração faz a transação recomeçar, em vez de ser
+sobrescrita.
+
+Uso (por padrão só mostra o que seria feito; --aplicar grava):
+    python migrar_operacoes.py [--aplicar] [--credenciais conta_de_servico.json]
+Sem --credenciais, usa [firebase_service_account] de .streamlit/secrets.toml, como o app.
+"""
+import argparse
+import json
+import tomllib
+
+import firebase_admin
+from firebase_admin import credentials, firestore
+
+# Mesmos nomes usados em app.py
+DB_COLLECTION = "cci_operacoes"
+DB_SUBCOLLECTION_HISTORICO = "historico"
+CAMPOS_LEGADOS = ['rating_final_operacao', 'historico_analises']
+
+# Uma transação aceita no máximo 500 gravações (análises copiadas + o próprio documento)
+LIMITE_GRAVACOES = 500
+
+
+def carregar_credenciais(caminho):
+    """Credenciais da conta de serviço: do JSON informado ou dos Secrets do Streamlit."""
+    if caminho:
+        with open(caminho, encoding='utf-8') as f:
+            return credentials.Certificate(json.load(f))
+    with open('.streamlit/secrets.toml', 'rb') as f:
+        return credentials.Certificate(dict(tomllib.load(f)['firebase_service_account']))
+
+
+def planejar(op_data, existentes):
+    """
+    Calcula a migração de uma operação a partir do documento e das análises já na subcoleção.
+    Retorna (análises a criar na subcoleção, campos a atualizar no documento) ou None se não há o que fazer.
+    """
+    legado = op_data.get('historico_analises')
+    legado = legado if isinstance(legado, dict) else {}
+    novas, atualizacao = {}, {}
+    if 'historico_analises' in op_data:
+        # IDs vazios ou com '/' não servem de documento: a operação fica para correção manual
+        if not all(ref and '/' not in ref for ref in legado):
+            raise ValueError(f"IDs de análise inválidos: {sorted(legado)}")
+        novas = {ref: analise for ref, analise in legado.items() if ref not in existentes}
+        atualizacao['historico_analises'] = firestore.DELETE_FIELD
+    if 'rating_final_operacao' not in op_data:
+        historico = {**legado, **existentes}
+        recente = historico[max(historico)] if historico else {}
+        atualizacao['rating_final_operacao'] = (recente or {}).get('resultados') or {}
+    if not atualizacao:
+        return None
+    if len(novas) + 1 > LIMITE_GRAVACOES:
+        raise ValueError(f"{len(novas)} análises legadas excedem o limite de uma transação")
+    return novas, atualizacao
+
+
+def migrar_operacao(db, doc_ref, aplicar):
+    """Migra uma operação numa transação. Retorna o plano executado (ou que seria executado)."""
+    @firestore.transactional
+    def executar(transaction):
+        snapshot = doc_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return None # Excluída desde a listagem
+        historico_ref = doc_ref.collection(DB_SUBCOLLECTION_HISTORICO)
+        existentes = {a.id: a.to_dict() for a in historico_ref.stream(transaction=transaction)}
+        plano = planejar(snapshot.to_dict() or {}, existentes)
+        if plano is not None and aplicar:
+            novas, atualizacao = plano
+            for ref, analise in novas.items():
+                transaction.create(historico_ref.document(ref), analise)
+            transaction.update(doc_ref, atualizacao)
+        return plano
+
+    return executar(db.transaction())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migra as operações salvas no formato antigo.")
+    parser.add_argument('--aplicar', action='store_true', help="grava as mudanças (sem isso, só lista)")
+    parser.add_argument('--credenciais', help="JSON da conta de serviço (padrão: .streamlit/secrets.toml)")
+    args = parser.parse_args()
+
+    firebase_admin.initialize_app(carregar_credenciais(args.credenciais))
+    db = firestore.client()
+
+    # A listagem só lê os campos legados; cada candidata é relida dentro da sua transação
+    candidatas = []
+    for op in db.collection(DB_COLLECTION).select(CAMPOS_LEGADOS).stream():
+        op_data = op.to_dict() or {}
+        if 'rating_final_operacao' not in op_data or 'historico_analises' in op_data:
+            candidatas.append(op.reference)
+
+    n_migradas, n_erros = 0, 0
+    for doc_ref in candidatas:
+        try:
+            plano = migrar_operacao(db, doc_ref, args.aplicar)
+        except Exception as e:
+            n_erros += 1
+            print(f"{doc_ref.id}: ERRO - {e}")
+            continue
+        if plano is None:
+            continue
+        novas, atualizacao = plano
+        n_migradas += 1
+        print(f"{doc_ref.id}: {len(novas)} análise(s) copiada(s); campos: {', '.join(sorted(atualizacao))}")
+
+    acao = "migradas" if args.aplicar else "a migrar (use --aplicar para gravar)"
+    print(f"{n_migradas} operação(ões) {acao}; {n_erros} com erro.")
+
+
+if __name__ == '__main__':
+    main()